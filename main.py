@@ -2,6 +2,9 @@
 import os
 import re
 import json
+import math
+import time
+import random
 import aiohttp
 import logging
 import asyncio
@@ -9,9 +12,15 @@ import ffmpeg
 import cv2
 import numpy as np
 from datetime import datetime
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
-from telethon import TelegramClient, events
-from functools import lru_cache
+from telethon import TelegramClient, events, helpers
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.functions.messages import UploadMediaRequest
+from telethon.tl.types import (
+    InputFileBig, InputPeerSelf, InputMediaUploadedPhoto, InputMediaUploadedDocument,
+    DocumentAttributeVideo, DocumentAttributeFilename
+)
 from PIL import Image
 from io import BytesIO
 import brotli  # Add Brotli import
@@ -147,8 +156,8 @@ async def enhance_video(input_path, output_path=None):
         output_path = input_path + '.enhanced.mp4'
     
     try:
-        # Đọc thông tin video
-        probe = ffmpeg.probe(input_path)
+        # Đọc thông tin video (chạy trong thread để không chặn event loop)
+        probe = await asyncio.to_thread(ffmpeg.probe, input_path)
         video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
         width = int(video_info['width'])
         height = int(video_info['height'])
@@ -171,11 +180,12 @@ async def enhance_video(input_path, output_path=None):
                              vcodec='libx264',
                              preset='medium',
                              crf=18,  # Chất lượng cao (0-51, thấp hơn = tốt hơn)
-                             acodec='copy')  # Giữ nguyên audio
+                             acodec='copy',  # Giữ nguyên audio
+                             movflags='+faststart')  # Đưa moov atom lên đầu để phát ngay khi stream
         
         # Chạy ffmpeg
         log('🎥 Đang nâng cao chất lượng video...')
-        ffmpeg.run(stream, capture_stdout=True, capture_stderr=True)
+        await asyncio.to_thread(ffmpeg.run, stream, capture_stdout=True, capture_stderr=True)
         log('✨ Đã nâng cao chất lượng video thành công')
         
         # Thay thế file gốc nếu cần
@@ -190,8 +200,30 @@ async def enhance_video(input_path, output_path=None):
         log(f'⚠️ Lỗi khi nâng cao chất lượng video: {e}')
         return False
 
+def upscale_image(img):
+    """Phóng to ảnh lên 4K nếu cạnh dài nhỏ hơn 3840px"""
+    width, height = img.size
+    if max(width, height) < 3840:
+        scale = 3840 / max(width, height)
+        new_width = int(width * scale)
+        new_height = int(height * scale)
+        log(f'🔄 Nâng cấp ảnh lên {new_width}x{new_height}')
+        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    return img
+
+async def enhance_file(filename):
+    """Nâng cao chất lượng file đã tải về (ảnh hoặc video)"""
+    if filename.lower().endswith(('.mp4', '.mov', '.avi')):
+        log('🎥 Đang nâng cao chất lượng video...')
+        return await enhance_video(filename)
+
+    img = upscale_image(Image.open(filename))
+    img.save(filename, 'JPEG', quality=100, optimize=True, subsampling=0)
+    log('🎨 Đang nâng cao chất lượng ảnh...')
+    return await enhance_image(filename)
+
 # ====== DOWNLOAD FUNCTION ======
-async def download_file(url, filename, max_retries=3):
+async def download_file(url, filename, max_retries=3, enhance=True):
     log(f'⬇️ Đang tải: {url}')
     retry_count = 0
     chunk_size = 4 * 1024 * 1024  # 4MB chunks for faster download
@@ -222,20 +254,17 @@ async def download_file(url, filename, max_retries=3):
                     log(f'📏 Kích thước gốc: {width}x{height}')
                     
                     # Calculate target size (4K or larger)
-                    if max(width, height) < 3840:
-                        scale = 3840 / max(width, height)
-                        new_width = int(width * scale)
-                        new_height = int(height * scale)
-                        log(f'🔄 Nâng cấp ảnh lên {new_width}x{new_height}')
-                        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+                    if enhance:
+                        img = upscale_image(img)
                     
                     # Save with maximum quality
                     log('💾 Đang lưu ảnh chất lượng cao...')
                     img.save(filename, 'JPEG', quality=100, optimize=True, subsampling=0)
                     
                     # Nâng cao chất lượng ảnh
-                    log('🎨 Đang nâng cao chất lượng ảnh...')
-                    await enhance_image(filename)
+                    if enhance:
+                        log('🎨 Đang nâng cao chất lượng ảnh...')
+                        await enhance_image(filename)
                     
                     log(f'✨ Đã lưu ảnh chất lượng cao: {filename}')
                 else:
@@ -253,7 +282,7 @@ async def download_file(url, filename, max_retries=3):
                 log(f'✅ Tải xuống hoàn tất: {filename}')
                 
                 # Nâng cao chất lượng video
-                if filename.lower().endswith(('.mp4', '.mov', '.avi')):
+                if enhance and filename.lower().endswith(('.mp4', '.mov', '.avi')):
                     log('🎥 Đang nâng cao chất lượng video...')
                     await enhance_video(filename)
                 
@@ -272,8 +301,459 @@ async def download_file(url, filename, max_retries=3):
                     os.remove(filename)
                 return False
 
+# ====== UPLOAD FUNCTIONS ======
+UPLOAD_PART_SIZE = 512 * 1024  # Kích thước tối đa của một phần upload Telegram
+UPLOAD_WORKERS = 8  # Số phần được upload song song
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024  # Telegram yêu cầu SaveBigFilePart cho file > 10MB
+THUMB_SIZE = 320  # Cạnh dài tối đa của thumbnail video
+TELEGRAM_PHOTO_MAX = 2560  # Cạnh dài tối đa của ảnh gửi dạng photo
+
+def probe_video(filename):
+    """Đọc thời lượng và kích thước video bằng ffprobe"""
+    probe = ffmpeg.probe(filename)
+    video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+    duration = float(video_info.get('duration') or probe['format'].get('duration') or 0)
+    return {
+        'duration': duration,
+        'width': int(video_info['width']),
+        'height': int(video_info['height'])
+    }
+
+def generate_thumbnail(filename, duration):
+    """Tạo thumbnail JPEG nhỏ từ một khung hình của video"""
+    thumb_path = filename + '.thumb.jpg'
+    try:
+        stream = ffmpeg.input(filename, ss=min(1.0, duration / 2))
+        stream = ffmpeg.filter(stream, 'scale', width=THUMB_SIZE, height=THUMB_SIZE,
+                               force_original_aspect_ratio='decrease')
+        stream = ffmpeg.output(stream, thumb_path, vframes=1, **{'q:v': 5})
+        ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+        return thumb_path if os.path.exists(thumb_path) else None
+    except ffmpeg.Error as e:
+        log(f'⚠️ Lỗi ffmpeg khi tạo thumbnail: {e.stderr.decode()}')
+    except Exception as e:
+        log(f'⚠️ Lỗi khi tạo thumbnail: {e}')
+    return None
+
+async def upload_file_parallel(filename):
+    """Upload file lên Telegram theo từng phần song song"""
+    file_size = os.path.getsize(filename)
+    if file_size <= BIG_FILE_THRESHOLD:
+        # File nhỏ: dùng upload mặc định của Telethon
+        return await client.upload_file(filename)
+
+    file_id = helpers.generate_random_long()
+    part_count = math.ceil(file_size / UPLOAD_PART_SIZE)
+    parts = asyncio.Queue()
+    for part_index in range(part_count):
+        parts.put_nowait(part_index)
+    uploaded = 0
+
+    async def worker():
+        nonlocal uploaded
+        with open(filename, 'rb') as f:
+            while not parts.empty():
+                part_index = parts.get_nowait()
+                f.seek(part_index * UPLOAD_PART_SIZE)
+                data = f.read(UPLOAD_PART_SIZE)
+                await client(SaveBigFilePartRequest(file_id, part_index, part_count, data))
+                uploaded += len(data)
+                log(f'\r📤 Tải lên: {uploaded / file_size * 100:.1f}% ({uploaded/1024/1024:.1f}/{file_size/1024/1024:.1f}MB)', end='')
+
+    log(f'📤 Upload {part_count} phần với {UPLOAD_WORKERS} luồng song song...')
+    workers = [asyncio.create_task(worker()) for _ in range(min(UPLOAD_WORKERS, part_count))]
+    try:
+        await asyncio.gather(*workers)
+    except Exception:
+        for task in workers:
+            task.cancel()
+        raise
+    log('')
+    return InputFileBig(file_id, part_count, os.path.basename(filename))
+
+async def upload_media(filename, file_type):
+    """Upload file lên Telegram và trả về media có thể gửi lại ở bất kỳ chat nào"""
+    if file_type == 'image':
+        # Telethon cũng thu nhỏ ảnh về cạnh này khi gửi dạng photo
+        img = Image.open(filename)
+        if max(img.size) > TELEGRAM_PHOTO_MAX:
+            img.thumbnail((TELEGRAM_PHOTO_MAX, TELEGRAM_PHOTO_MAX), Image.Resampling.LANCZOS)
+            img.save(filename, 'JPEG', quality=100, optimize=True, subsampling=0)
+        media = InputMediaUploadedPhoto(file=await client.upload_file(filename))
+        return await client(UploadMediaRequest(InputPeerSelf(), media))
+
+    # ffprobe/ffmpeg chạy trong thread để không chặn event loop
+    try:
+        info = await asyncio.to_thread(probe_video, filename)
+    except ffmpeg.Error as e:
+        log(f'⚠️ Lỗi ffprobe, gửi video không kèm thuộc tính: {e.stderr.decode()}')
+        info = None
+    except Exception as e:
+        log(f'⚠️ Không đọc được thông tin video, gửi video không kèm thuộc tính: {e}')
+        info = None
+
+    thumb_path = None
+    if info:
+        thumb_path = await asyncio.to_thread(generate_thumbnail, filename, info['duration'])
+    try:
+        uploaded = await upload_file_parallel(filename)
+        thumb = await client.upload_file(thumb_path) if thumb_path else None
+        attributes = [DocumentAttributeFilename(os.path.basename(filename))]
+        if info:
+            attributes.insert(0, DocumentAttributeVideo(
+                duration=int(round(info['duration'])),
+                w=info['width'],
+                h=info['height'],
+                supports_streaming=True
+            ))
+        media = InputMediaUploadedDocument(
+            file=uploaded,
+            mime_type='video/mp4',
+            attributes=attributes,
+            thumb=thumb
+        )
+        return await client(UploadMediaRequest(InputPeerSelf(), media))
+    finally:
+        if thumb_path and os.path.exists(thumb_path):
+            os.remove(thumb_path)
+
+# ====== MEDIA DEDUPLICATION ======
+VIDEO_HASH_FRAMES = 4  # Số khung hình mẫu dùng để băm video
+HASH_MAX_DISTANCE = 6  # Khoảng cách Hamming trung bình tối đa (trên 64 bit) để coi là trùng
+HASH_MIN_BITS = 8  # Hash có ít hơn số bit 0/1 này (ảnh trơn, ít chi tiết) không đủ tin cậy
+ASPECT_TOLERANCE = 0.02  # Chênh lệch tỉ lệ khung hình tối đa giữa hai media trùng
+MEDIA_INDEX_MAX = 5000  # Số media tối đa được giữ trong chỉ mục
+MEDIA_INDEX_TTL = 12 * 3600  # Sau thời gian này file_reference có thể hết hạn, không dùng lại nữa
+
+def dhash(gray):
+    """Tính dHash 64 bit của một ảnh xám"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    diff = small[:, 1:] > small[:, :-1]
+    return np.packbits(diff.flatten()).view('>u8')[0].astype(np.uint64)
+
+def image_hash(filename):
+    gray = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    height, width = gray.shape
+    return np.array([dhash(gray)], dtype=np.uint64), width / height
+
+def video_hash(filename):
+    """Băm các khung hình ở những vị trí cố định trong video"""
+    capture = cv2.VideoCapture(filename)
+    try:
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count <= 0:
+            return None
+        hashes = []
+        for i in range(VIDEO_HASH_FRAMES):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, frame_count * (i + 1) // (VIDEO_HASH_FRAMES + 1))
+            ok, frame = capture.read()
+            if not ok:
+                return None
+            hashes.append(dhash(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)))
+        height, width = frame.shape[:2]
+        return np.array(hashes, dtype=np.uint64), width / height
+    finally:
+        capture.release()
+
+def compute_media_hash(filename, file_type):
+    """Trả về chữ ký {'hash', 'aspect'} của media, hoặc None nếu không đủ tin cậy để so trùng"""
+    try:
+        result = video_hash(filename) if file_type == 'video' else image_hash(filename)
+    except Exception as e:
+        log(f'⚠️ Lỗi khi tính hash media: {e}')
+        return None
+    if result is None:
+        return None
+    hashes, aspect = result
+    bit_counts = np.unpackbits(hashes.view(np.uint8).reshape(len(hashes), -1), axis=1).sum(axis=1)
+    if bit_counts.min() < HASH_MIN_BITS or bit_counts.max() > 64 - HASH_MIN_BITS:
+        log('ℹ️ Media quá ít chi tiết, bỏ qua kiểm tra trùng lặp')
+        return None
+    return {'hash': hashes, 'aspect': aspect}
+
+class MediaIndex:
+    """Chỉ mục hash cảm nhận của media đã gửi, tra cứu theo khoảng cách Hamming"""
+
+    def __init__(self, max_size=MEDIA_INDEX_MAX, ttl=MEDIA_INDEX_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hashes = {}  # file_type -> np.ndarray (N, số hash) uint64
+        self.aspects = {}  # file_type -> np.ndarray (N,) tỉ lệ khung hình
+        self.added = {}  # file_type -> np.ndarray (N,) thời điểm thêm vào chỉ mục
+        self.media = {}  # file_type -> danh sách media Telegram tương ứng
+
+    def lookup(self, file_type, signature):
+        hashes = self.hashes.get(file_type)
+        if signature is None or hashes is None or hashes.shape[1] != len(signature['hash']):
+            return None
+        xor = np.bitwise_xor(hashes, signature['hash'])
+        distances = np.unpackbits(xor.view(np.uint8), axis=1).sum(axis=1) / len(signature['hash'])
+        # Chỉ xét media có cùng tỉ lệ khung hình và file_reference chưa quá hạn
+        aspect_match = np.abs(self.aspects[file_type] - signature['aspect']) <= ASPECT_TOLERANCE * signature['aspect']
+        fresh = time.time() - self.added[file_type] <= self.ttl
+        distances = np.where(aspect_match & fresh, distances, np.inf)
+        best = int(np.argmin(distances))
+        if distances[best] <= HASH_MAX_DISTANCE:
+            return self.media[file_type][best]
+        return None
+
+    def add(self, file_type, signature, media):
+        if signature is None or media is None:
+            return
+        media_hash = signature['hash']
+        hashes = self.hashes.get(file_type)
+        if hashes is None or hashes.shape[1] != len(media_hash):
+            self.hashes[file_type] = media_hash[np.newaxis, :]
+            self.aspects[file_type] = np.array([signature['aspect']])
+            self.added[file_type] = np.array([time.time()])
+            self.media[file_type] = [media]
+            return
+        self.hashes[file_type] = np.vstack([hashes, media_hash])[-self.max_size:]
+        self.aspects[file_type] = np.append(self.aspects[file_type], signature['aspect'])[-self.max_size:]
+        self.added[file_type] = np.append(self.added[file_type], time.time())[-self.max_size:]
+        self.media[file_type] = (self.media[file_type] + [media])[-self.max_size:]
+
+    def evict(self, media):
+        """Xoá media khỏi chỉ mục (ví dụ khi gửi lại thất bại)"""
+        for file_type, media_list in self.media.items():
+            for i, item in enumerate(media_list):
+                if item is media:
+                    self.hashes[file_type] = np.delete(self.hashes[file_type], i, axis=0)
+                    self.aspects[file_type] = np.delete(self.aspects[file_type], i)
+                    self.added[file_type] = np.delete(self.added[file_type], i)
+                    del media_list[i]
+                    return True
+        return False
+
+media_index = MediaIndex()
+
+# ====== VARIANT STATS ======
+VARIANT_STATS_FILE = 'variant_stats.json'
+QUALITY_VARIANTS = [
+    ('/originals/', '.mp4'),
+    ('/h265_4k/', '.mp4'),
+    ('/hevc_4k/', '.mp4'),
+    ('/4k/', '.mp4'),
+    ('/2160p/', '.mp4'),
+    ('/h265_1440p/', '.mp4'),
+    ('/1440p/', '.mp4'),
+    ('/1080p/', '.mp4')
+]
+VARIANT_DEAD_MIN_TRIES = 20  # Số lần thử tối thiểu trước khi coi một biến thể là "chết"
+VARIANT_DEAD_AFTER = 7 * 24 * 3600  # Không có kết quả trong 7 ngày thì bỏ qua
+VARIANT_EXPLORE_RATE = 0.05  # Xác suất vẫn thử lại biến thể đã bị bỏ qua
+VARIANT_MIN_HIT_RATE = 0.02  # Dưới tỉ lệ này thì biến thể được coi là khó tồn tại
+VARIANT_STATS_WINDOW = 200  # Vượt số lần thử này thì giảm một nửa bộ đếm
+
+variant_stats = None
+variant_stats_dirty = False
+
+def load_variant_stats():
+    global variant_stats
+    if variant_stats is None:
+        variant_stats = {}
+        if os.path.exists(VARIANT_STATS_FILE):
+            try:
+                with open(VARIANT_STATS_FILE, 'r') as f:
+                    variant_stats = json.load(f)
+            except Exception as e:
+                log(f'⚠️ Không thể đọc thống kê biến thể video: {e}')
+    return variant_stats
+
+def save_variant_stats():
+    global variant_stats_dirty
+    if not variant_stats_dirty:
+        return
+    try:
+        tmp_file = VARIANT_STATS_FILE + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(variant_stats, f, indent=4)
+        os.replace(tmp_file, VARIANT_STATS_FILE)
+        variant_stats_dirty = False
+    except Exception as e:
+        log(f'⚠️ Không thể lưu thống kê biến thể video: {e}')
+
+def variant_stats_key(video_url):
+    """Khoá thống kê theo CDN host và dạng URL (bỏ các đoạn hash/số)"""
+    parts = urlsplit(video_url)
+    segments = []
+    for segment in parts.path.split('/')[:-1]:
+        if not segment:
+            continue
+        if re.fullmatch(r'[0-9a-f]{2}|[0-9a-f]{16,}|\d+', segment):
+            segment = '*'
+        if not segments or segments[-1] != segment or segment != '*':
+            segments.append(segment)
+    return parts.netloc + '/' + '/'.join(segments)
+
+def plausible_quality_variants(video_url):
+    """Các biến thể chất lượng còn khả năng tồn tại, giữ nguyên thứ tự chất lượng"""
+    stats = load_variant_stats().get(variant_stats_key(video_url), {})
+    now = time.time()
+    variants = []
+    for path, ext in QUALITY_VARIANTS:
+        entry = stats.get(path, {'hits': 0, 'tries': 0, 'last_hit': 0})
+        if entry['tries'] >= VARIANT_DEAD_MIN_TRIES:
+            # Ước lượng Laplace để biến thể ít dữ liệu không bị loại quá sớm
+            hit_rate = (entry['hits'] + 1) / (entry['tries'] + 2)
+            is_dead = now - entry.get('last_hit', 0) > VARIANT_DEAD_AFTER
+            if (is_dead or hit_rate < VARIANT_MIN_HIT_RATE) and random.random() >= VARIANT_EXPLORE_RATE:
+                continue
+        variants.append((path, ext))
+    return variants
+
+def record_variant_result(video_url, path, found):
+    global variant_stats_dirty
+    stats = load_variant_stats().setdefault(variant_stats_key(video_url), {})
+    entry = stats.setdefault(path, {'hits': 0, 'tries': 0, 'last_hit': 0})
+    entry['tries'] += 1
+    if found:
+        entry['hits'] += 1
+        entry['last_hit'] = time.time()
+    # Giảm một nửa bộ đếm khi vượt cửa sổ để thống kê theo sát tình trạng hiện tại của CDN
+    if entry['tries'] > VARIANT_STATS_WINDOW:
+        entry['hits'] /= 2
+        entry['tries'] /= 2
+    variant_stats_dirty = True
+
+# ====== IMAGE PROBE ======
+IMAGE_PROBE_BYTES = 64 * 1024  # Số byte đầu tối đa đọc để lấy header ảnh
+IMAGE_PROBE_CONCURRENCY = 6  # Số ảnh được kiểm tra song song
+
+def webp_size(data):
+    """Đọc kích thước WebP từ header RIFF (Pillow không mở được WebP bị cắt)"""
+    if len(data) < 30 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        width = int.from_bytes(data[26:28], 'little') & 0x3fff
+        height = int.from_bytes(data[28:30], 'little') & 0x3fff
+    elif chunk == b'VP8L' and data[20] == 0x2f:
+        bits = int.from_bytes(data[21:25], 'little')
+        width = (bits & 0x3fff) + 1
+        height = ((bits >> 14) & 0x3fff) + 1
+    elif chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+    else:
+        return None
+    return width, height
+
+async def probe_image_header(url, headers):
+    """Đọc định dạng và kích thước thật của ảnh chỉ từ vài KB đầu (HTTP Range)
+
+    Trả về None nếu không xác định được, {'url', 'http_error': True} nếu server trả lỗi HTTP
+    """
+    session = await get_session()
+    range_headers = dict(headers, Range=f'bytes=0-{IMAGE_PROBE_BYTES - 1}')
+    timeout = aiohttp.ClientTimeout(total=10)
+    try:
+        async with session.get(url, headers=range_headers, timeout=timeout) as response:
+            if response.status not in (200, 206):
+                log(f'⚠️ Ảnh không khả dụng (HTTP {response.status}): {url}')
+                return {'url': url, 'http_error': True}
+            data = b''
+            # Nếu server bỏ qua Range (200), vẫn chỉ đọc phần đầu rồi đóng kết nối
+            async for chunk in response.content.iter_chunked(8192):
+                data += chunk
+                if data[:4] == b'RIFF':
+                    size = webp_size(data)
+                    if size is None and len(data) < 30:
+                        continue
+                    if size is None:
+                        break
+                    width, height = size
+                    log(f'📏 Ảnh {url}: WEBP {width}x{height}')
+                    return {'url': url, 'format': 'WEBP', 'width': width, 'height': height}
+                try:
+                    img = Image.open(BytesIO(data))
+                except Exception:
+                    if len(data) >= IMAGE_PROBE_BYTES:
+                        break
+                    continue
+                width, height = img.size
+                log(f'📏 Ảnh {url}: {img.format} {width}x{height}')
+                return {'url': url, 'format': img.format, 'width': width, 'height': height}
+    except Exception as e:
+        log(f'⚠️ Lỗi khi kiểm tra ảnh {url}: {e}')
+        return None
+    log(f'⚠️ Không đọc được header ảnh: {url}')
+    return None
+
+async def rank_image_candidates(urls, headers):
+    """Kiểm tra song song các ảnh; trả về (ảnh sắp theo độ phân giải thật, tập URL lỗi HTTP)"""
+    urls = list(dict.fromkeys(url for url in urls if url))
+    semaphore = asyncio.Semaphore(IMAGE_PROBE_CONCURRENCY)
+
+    async def probe(url):
+        async with semaphore:
+            return await probe_image_header(url, headers)
+
+    results = await asyncio.gather(*(probe(url) for url in urls))
+    ranked = [r for r in results if r and not r.get('http_error')]
+    failed = {r['url'] for r in results if r and r.get('http_error')}
+    # sort ổn định: cùng độ phân giải thì giữ thứ tự tìm thấy
+    ranked.sort(key=lambda r: r['width'] * r['height'], reverse=True)
+    return ranked, failed
+
 # ====== PINTEREST EXTRACTOR ======
-@lru_cache(maxsize=100)
+async def resolve_short_link(pin_url):
+    """Giải quyết link ngắn (pin.it, /i/) thành link Pinterest đầy đủ"""
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Accept': '*/*',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Connection': 'keep-alive',
+        'Cookie': '_auth=1'  # Thêm cookie để cải thiện khả năng truy cập
+    }
+    session = await get_session()
+
+    retry_count = 0
+    max_retries = 3
+    while retry_count < max_retries:
+        try:
+            log(f'🔄 Đang giải quyết link ngắn (lần thử {retry_count + 1})...')
+            timeout = aiohttp.ClientTimeout(total=10)  # 10 seconds timeout
+            async with session.get(pin_url, headers=headers, allow_redirects=True, timeout=timeout) as response:
+                if response.status == 200:
+                    # Get the final URL after redirects
+                    final_url = str(response.url)
+                    log(f'➡ Link gốc: {final_url}')
+
+                    # Try to find canonical URL from the page
+                    content = await response.text()
+                    soup = BeautifulSoup(content, "html.parser")
+                    meta = soup.find("link", rel="canonical")
+                    if meta and meta.get('href'):
+                        final_url = meta['href']
+                        log(f'➡ Link chính thức: {final_url}')
+
+                    # Update pin_url to the resolved URL if it's valid
+                    if 'pinterest.com' in final_url:
+                        pin_url = final_url
+                        break
+                    else:
+                        log('⚠️ Link đích không phải Pinterest, thử lại...')
+                else:
+                    log(f'⚠️ Lỗi HTTP {response.status}, thử lại...')
+
+        except asyncio.TimeoutError:
+            log('⚠️ Hết thời gian chờ, thử lại...')
+        except Exception as e:
+            log(f'⚠️ Lỗi khi giải quyết link ngắn: {e}')
+
+        retry_count += 1
+        if retry_count < max_retries:
+            wait_time = 2 ** retry_count
+            log(f'⌛ Chờ {wait_time}s trước khi thử lại...')
+            await asyncio.sleep(wait_time)
+        else:
+            log('❌ Không thể giải quyết link ngắn sau nhiều lần thử')
+
+    return pin_url
+
 async def extract_pinterest_media(pin_url):
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -288,47 +768,7 @@ async def extract_pinterest_media(pin_url):
     try:
         # Handle short links with retries
         if 'pin.it' in pin_url or '/i/' in pin_url:
-            retry_count = 0
-            max_retries = 3
-            while retry_count < max_retries:
-                try:
-                    log(f'🔄 Đang giải quyết link ngắn (lần thử {retry_count + 1})...')
-                    timeout = aiohttp.ClientTimeout(total=10)  # 10 seconds timeout
-                    async with session.get(pin_url, headers=headers, allow_redirects=True, timeout=timeout) as response:
-                        if response.status == 200:
-                            # Get the final URL after redirects
-                            final_url = str(response.url)
-                            log(f'➡ Link gốc: {final_url}')
-                            
-                            # Try to find canonical URL from the page
-                            content = await response.text()
-                            soup = BeautifulSoup(content, "html.parser")
-                            meta = soup.find("link", rel="canonical")
-                            if meta and meta.get('href'):
-                                final_url = meta['href']
-                                log(f'➡ Link chính thức: {final_url}')
-                            
-                            # Update pin_url to the resolved URL if it's valid
-                            if 'pinterest.com' in final_url:
-                                pin_url = final_url
-                                break
-                            else:
-                                log('⚠️ Link đích không phải Pinterest, thử lại...')
-                        else:
-                            log(f'⚠️ Lỗi HTTP {response.status}, thử lại...')
-                    
-                except asyncio.TimeoutError:
-                    log('⚠️ Hết thời gian chờ, thử lại...')
-                except Exception as e:
-                    log(f'⚠️ Lỗi khi giải quyết link ngắn: {e}')
-                
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = 2 ** retry_count
-                    log(f'⌛ Chờ {wait_time}s trước khi thử lại...')
-                    await asyncio.sleep(wait_time)
-                else:
-                    log('❌ Không thể giải quyết link ngắn sau nhiều lần thử')
+            pin_url = await resolve_short_link(pin_url)
 
         async with session.get(pin_url, headers=headers) as response:
             if response.status != 200:
@@ -462,30 +902,24 @@ async def extract_pinterest_media(pin_url):
                     return 'video', best_video['url']
 
                 # If no direct URL works, try quality variants
+                # Bỏ qua biến thể khó tồn tại, thử theo thứ tự chất lượng và dừng ở biến thể đầu tiên khả dụng
                 for video_url in video_candidates:
                     base_url = video_url.split('/hls/')[0] if '/hls/' in video_url else video_url.rsplit('/', 1)[0]
-                    quality_variants = [
-                        ('/originals/', '.mp4'),
-                        ('/h265_4k/', '.mp4'),
-                        ('/hevc_4k/', '.mp4'),
-                        ('/4k/', '.mp4'),
-                        ('/2160p/', '.mp4'),
-                        ('/h265_1440p/', '.mp4'),
-                        ('/1440p/', '.mp4'),
-                        ('/1080p/', '.mp4')
-                    ]
-                    
-                    for path, ext in quality_variants:
+                    for path, ext in plausible_quality_variants(video_url):
                         try:
                             test_url = f"{base_url}{path}video{ext}"
                             async with session.head(test_url, headers=headers) as resp:
+                                record_variant_result(video_url, path, resp.status == 200)
                                 if resp.status == 200:
                                     size = int(resp.headers.get('content-length', 0))
-                                    if size > best_video['size']:
-                                        best_video = {'url': test_url, 'size': size}
-                                        log(f'📈 Tìm thấy phiên bản tốt hơn: {test_url} ({size/1024/1024:.1f}MB)')
+                                    best_video = {'url': test_url, 'size': size}
+                                    log(f'📈 Tìm thấy phiên bản khả dụng: {test_url} ({size/1024/1024:.1f}MB)')
+                                    break
                         except:
                             continue
+                    if best_video['url']:
+                        break
+                save_variant_stats()
                 
                 # Return best video found or first available
                 if best_video['url']:
@@ -498,7 +932,8 @@ async def extract_pinterest_media(pin_url):
                 log('❌ Không tìm thấy video hợp lệ, thử tìm ảnh...')
 
             # Tìm ảnh với chất lượng cao nhất
-            img_sources = []
+            pin_images = []  # Ảnh của chính pin (meta tags) và các biến thể kích thước
+            img_sources = []  # Các thẻ img khác trên trang, chỉ dùng dự phòng
             
             # Kiểm tra các meta tags khác nhau
             meta_tags = [
@@ -515,13 +950,17 @@ async def extract_pinterest_media(pin_url):
                 if elem:
                     url = elem.get('content') or elem.get('href')
                     if url:
+                        sized_url = url
                         # Chuyển đổi URL sang độ phân giải cao nhất
                         if 'pinimg.com' in url:
                             # Thay thế kích thước ảnh để lấy bản chất lượng cao nhất
                             url = re.sub(r'/\d+x/', '/originals/', url)
                             log(f'🔄 Nâng cấp ảnh lên chất lượng cao nhất: {url}')
-                        img_sources.append(url)
+                        pin_images.append(url)
                         log(f'✅ Tìm thấy ảnh từ {tag}: {url}')
+                        # Giữ bản có kích thước làm dự phòng nếu ảnh gốc không khả dụng
+                        if sized_url != url:
+                            pin_images.append(sized_url)
 
             log("🔍 Tìm kiếm ảnh trong thẻ img...")
             # Tìm tất cả thẻ img có độ phân giải cao
@@ -530,6 +969,7 @@ async def extract_pinterest_media(pin_url):
                 if not src:
                     continue
                 
+                sized_src = src
                 # Chuyển đổi URL sang độ phân giải cao nhất nếu là ảnh Pinterest
                 if 'pinimg.com' in src:
                     src = re.sub(r'/\d+x/', '/originals/', src)
@@ -541,58 +981,111 @@ async def extract_pinterest_media(pin_url):
                 elif 'src' in img.attrs:
                     img_sources.append(src)
                     log(f'✅ Tìm thấy ảnh: {src}')
+                if sized_src != src:
+                    img_sources.append(sized_src)
 
-            # Chọn ảnh có độ phân giải cao nhất
-            log(f"🔍 Đánh giá {len(img_sources)} ảnh tìm thấy...")
-            best_image = None
-            max_resolution = 0
-
-            for img_url in img_sources:
-                try:
-                    # Nếu là ảnh gốc, ưu tiên sử dụng ngay
-                    if 'originals' in img_url:
-                        log(f'🎯 Tìm thấy ảnh gốc: {img_url}')
-                        return 'image', img_url
-
-                    # Chuyển đổi URL sang độ phân giải cao nhất nếu là ảnh Pinterest
-                    if 'pinimg.com' in img_url:
-                        original_url = re.sub(r'/\d+x/', '/originals/', img_url)
-                        log(f'🔄 Thử truy cập ảnh gốc: {original_url}')
-                        try:
-                            async with session.head(original_url, headers=headers) as response:
-                                if response.status == 200:
-                                    log(f'✅ Ảnh gốc khả dụng!')
-                                    return 'image', original_url
-                        except:
-                            log('⚠️ Không thể truy cập ảnh gốc, dùng ảnh thay thế')
-
-                    # Kiểm tra độ phân giải
-                    res_match = re.search(r'(\d+)x(\d+)', img_url)
-                    if res_match:
-                        resolution = int(res_match.group(1)) * int(res_match.group(2))
-                        log(f'📏 Ảnh {img_url} có độ phân giải: {res_match.group(1)}x{res_match.group(2)}')
-                        if resolution > max_resolution:
-                            max_resolution = resolution
-                            best_image = img_url
-                            log(f'📈 Cập nhật ảnh chất lượng cao nhất: {img_url}')
-                except Exception as e:
-                    log(f'⚠️ Lỗi khi xử lý ảnh {img_url}: {e}')
-                    continue
-
-            if best_image:
-                log(f'✅ Chọn ảnh tốt nhất: {best_image}')
-                return 'image', best_image
+            # Chỉ so sánh các biến thể kích thước của ảnh pin, dựa trên header thật của ảnh
+            log(f"🔍 Đánh giá {len(pin_images)} biến thể ảnh của pin...")
+            ranked_images, failed_images = await rank_image_candidates(pin_images, headers)
+            if not ranked_images and img_sources:
+                # Không có biến thể nào của ảnh pin dùng được: kiểm tra các ảnh khác trên trang
+                log(f"🔍 Ảnh của pin không khả dụng, đánh giá {len(img_sources)} ảnh khác...")
+                ranked_images, failed_others = await rank_image_candidates(img_sources, headers)
+                failed_images |= failed_others
+            if ranked_images:
+                best_image = ranked_images[0]
+                log(f'✅ Chọn ảnh tốt nhất: {best_image["url"]} ({best_image["format"]} {best_image["width"]}x{best_image["height"]})')
+                return 'image', best_image['url']
             
-            # Nếu không tìm thấy ảnh nào phù hợp, thử dùng ảnh đầu tiên
-            if img_sources:
-                log(f'⚠️ Không tìm được ảnh chất lượng cao, dùng ảnh đầu tiên: {img_sources[0]}')
-                return 'image', img_sources[0]
+            # Nếu không đọc được header ảnh nào, dùng ảnh đầu tiên chưa bị lỗi HTTP (ưu tiên ảnh của pin)
+            fallback_images = [url for url in pin_images + img_sources if url not in failed_images]
+            if fallback_images:
+                log(f'⚠️ Không tìm được ảnh chất lượng cao, dùng ảnh đầu tiên: {fallback_images[0]}')
+                return 'image', fallback_images[0]
 
     except Exception as e:
         log(f'Lỗi khi trích xuất media: {e}')
     
     return None, None
 
+# ====== PIN PROCESSING ======
+OUTPUT_PROFILE = 'enhanced-4k'  # Cấu hình đầu ra hiện tại (nâng cấp 4K + làm nét)
+
+async def process_pin(pin_url, reuse=True):
+    """Trích xuất, tải, nâng cao chất lượng và upload media của một pin
+
+    Trả về {'media': media Telegram, 'reused': True nếu dùng lại media trùng đã gửi}
+    """
+    file_type, url = await extract_pinterest_media(pin_url)
+    if not url:
+        return None
+
+    filename = datetime.now().strftime("%d%m%H%M%S") + f"_{random.getrandbits(32):08x}"
+    filename += '.mp4' if file_type == 'video' else '.jpg'
+
+    try:
+        if not await download_file(url, filename, enhance=False):
+            log(f'❌ Không thể tải: {url}')
+            return None
+        log(f'✅ Đã tải thành công: {url}')
+
+        # Kiểm tra media trùng lặp trước khi nâng cao chất lượng
+        media_hash = await asyncio.to_thread(compute_media_hash, filename, file_type)
+        duplicate = media_index.lookup(file_type, media_hash) if reuse else None
+        if duplicate is not None:
+            log(f'♻️ Media trùng với file đã gửi trước đó, dùng lại: {url}')
+            return {'media': duplicate, 'reused': True}
+
+        await enhance_file(filename)
+
+        file_size = os.path.getsize(filename)
+        log(f'📤 Đang upload file {filename} ({file_size/1024/1024:.1f}MB)...')
+        media = await upload_media(filename, file_type)
+        media_index.add(file_type, media_hash, media)
+        log(f'✅ Đã upload thành công: {filename}')
+        return {'media': media, 'reused': False}
+    finally:
+        # Xóa file ngay sau khi upload
+        if os.path.exists(filename):
+            os.remove(filename)
+            log(f'🧹 Đã xoá file: {filename}')
+
+# ====== SINGLE-FLIGHT ======
+inflight_jobs = {}  # khoá -> {'task': job đang chạy, 'waiters': số yêu cầu đang chờ}
+
+def pin_job_key(pin_url):
+    """Khoá gộp yêu cầu: ID pin chuẩn và cấu hình đầu ra"""
+    match = re.search(r'/pin/(?:[^/]*--)?(\d+)', pin_url)
+    pin_id = match.group(1) if match else pin_url.split('?')[0].rstrip('/')
+    return (pin_id, OUTPUT_PROFILE)
+
+async def single_flight(key, job):
+    """Chạy job một lần cho mỗi khoá; các yêu cầu trùng đồng thời chờ cùng kết quả"""
+    entry = inflight_jobs.get(key)
+    if entry is None:
+        entry = {'task': asyncio.create_task(job()), 'waiters': 0}
+        inflight_jobs[key] = entry
+
+        def release(_):
+            if inflight_jobs.get(key) is entry:
+                del inflight_jobs[key]
+        entry['task'].add_done_callback(release)
+    else:
+        log(f'🔗 Pin {key[0]} đang được xử lý, chờ kết quả chung...')
+
+    entry['waiters'] += 1
+    try:
+        # shield: một yêu cầu bị huỷ không kéo theo job của các yêu cầu khác
+        return await asyncio.shield(entry['task'])
+    finally:
+        entry['waiters'] -= 1
+        if entry['waiters'] == 0 and not entry['task'].done():
+            log(f'🛑 Không còn yêu cầu nào chờ pin {key[0]}, huỷ xử lý')
+            # Gỡ khoá ngay để yêu cầu mới không nhập vào job đang bị huỷ
+            if inflight_jobs.get(key) is entry:
+                del inflight_jobs[key]
+            entry['task'].cancel()
+
 # ====== COMMAND HANDLERS ======
 @client.on(events.NewMessage(pattern='/start'))
 async def start_handler(event):
@@ -628,59 +1121,44 @@ async def handler(event):
         for link in links:
             try:
                 log(f'Xử lý link: {link} trong {chat_info}')
-                file_type, url = await extract_pinterest_media(link)
+                pin_url = link
+                if 'pin.it' in link or '/i/' in link:
+                    pin_url = await resolve_short_link(link)
 
-                if not url:
-                    continue
-
-                filename = datetime.now().strftime("%d%m%H%M%S") + f"_{len(processed)}"
-                if file_type == 'video':
-                    filename += '.mp4'
-                elif file_type == 'image':
-                    filename += '.jpg'
-
-                if await download_file(url, filename):
-                    processed.append(filename)
-                    log(f'✅ Đã tải thành công: {url}')
-                else:
-                    log(f'❌ Không thể tải: {url}')
+                # Gộp các yêu cầu trùng đang xử lý cùng lúc
+                result = await single_flight(pin_job_key(pin_url), lambda: process_pin(pin_url))
+                if result is not None:
+                    processed.append((pin_url, result))
             except Exception as e:
                 log(f'❌ Lỗi khi xử lý {link}: {e}')
 
         if processed:
             try:
-                # Gửi từng file một để tối ưu tốc độ
-                for filename in processed:
+                # Gửi từng media một
+                for pin_url, result in processed:
                     try:
-                        file_size = os.path.getsize(filename)
-                        log(f'📤 Đang gửi file {filename} ({file_size/1024/1024:.1f}MB)...')
-                        
-                        # Gửi file
-                        await event.reply(file=filename)
-                        log(f'✅ Đã gửi thành công: {filename}')
-                        
-                        # Xóa file ngay sau khi gửi
-                        os.remove(filename)
-                        log(f'🧹 Đã xoá file: {filename}')
+                        try:
+                            await event.reply(file=result['media'])
+                        except Exception as e:
+                            if not result['reused']:
+                                raise
+                            # Media dùng lại có thể đã hết hạn file_reference: bỏ khỏi chỉ mục và xử lý lại từ đầu
+                            log(f'⚠️ Không gửi lại được media trùng ({e}), xử lý lại pin...')
+                            media_index.evict(result['media'])
+                            result = await single_flight(pin_job_key(pin_url) + ('fresh',),
+                                                         lambda: process_pin(pin_url, reuse=False))
+                            if result is None:
+                                continue
+                            await event.reply(file=result['media'])
+                        log('✅ Đã gửi thành công')
                     except Exception as e:
-                        log(f'⚠️ Lỗi khi xử lý file {filename}: {e}')
-                        # Đảm bảo xóa file ngay cả khi gặp lỗi
-                        if os.path.exists(filename):
-                            os.remove(filename)
+                        log(f'⚠️ Lỗi khi gửi media: {e}')
                 
                 # Xóa tin nhắn "đang xử lý"
                 await processing_msg.delete()
                 log(f'✨ Đã xử lý xong {len(processed)} file trong {chat_info}')
             except Exception as e:
                 log(f'❌ Lỗi khi gửi files: {e}')
-                # Dọn dẹp tất cả file còn sót lại
-                for filename in processed:
-                    if os.path.exists(filename):
-                        try:
-                            os.remove(filename)
-                            log(f'🧹 Đã xoá file thừa: {filename}')
-                        except:
-                            pass
         else:
             await event.reply("❌ Không tìm thấy ảnh hoặc video hợp lệ.")
             log(f'⚠️ Không tìm thấy media hợp lệ trong {chat_info}')
@@ -696,6 +1174,9 @@ async def shutdown(signal_=None):
         log(f"\n📢 Nhận tín hiệu: {signal_.name}")
     log("🔄 Đang dừng bot...")
     
+    # Lưu thống kê biến thể video
+    save_variant_stats()
+    
     # Close the aiohttp session
     if session:
         log("🔒 Đóng phiên HTTP...")